@@ -3,105 +3,249 @@
 # streamlit
 # pdfplumber
 # pandas
-# openpyxl
+# xlsxwriter
 # PyPDF2
+# pypdfium2
 
 import streamlit as st
 import pandas as pd
-import tempfile
+import numpy as np
+import io
 import pdfplumber
+import pypdfium2 as pdfium
 from PyPDF2 import PdfReader, PdfWriter
 import re
-import os
 import unicodedata
+from functools import lru_cache
 
 # -----------------------------
 # Regex Patterns (Universal)
 # -----------------------------
-DATE_RE = re.compile(r'[A-Za-z]{3}\s+\d{1,2},\s*\d{4}')
-TIME_RE = re.compile(r'\d{1,2}[:￾]\d{2}\s*(am|pm)', re.IGNORECASE)
-AMOUNT_RE = re.compile(r'(DEBIT|CREDIT)\s*[₹]?\s*([\d,]+)', re.IGNORECASE)
-DETAILS_RE = re.compile(
-    r'(Paid to|Received from)\s+(.+?)\s+(DEBIT|CREDIT)',
-    re.IGNORECASE | re.DOTALL
+# All per-chunk fields in one alternation, so each chunk is scanned once.
+# The match's lastgroup names the field it found. Dates and times never
+# span lines, so they use [ \t] and possessive quantifiers to fail fast;
+# re.ASCII keeps \d and case folding off the Unicode tables. Details may
+# wrap onto a second line (DOTALL) but are capped so a row with no
+# DEBIT/CREDIT token gives up after 200 characters. Details and amount
+# are captured inside lookaheads: finditer matches never overlap, so a
+# consumed span would hide a date or time inside it (e.g. a time line
+# between the two halves of a wrapped merchant name).
+FIELDS_RE = re.compile(
+    r'(?:Paid to|Received from)(?=\s+(?P<details>.{1,200}?)\s+(?:DEBIT|CREDIT))'
+    r'|(?P<type>DEBIT|CREDIT)(?=\s*+[₹]?\s*+(?P<amount>\d[\d,]*+))'
+    r'|(?P<date>[A-Za-z]{3}[ \t]++\d{1,2},[ \t]*+\d{4})'
+    r'|(?P<time>\d{1,2}[:￾]\d{2}[ \t]*+(?:am|pm))',
+    re.IGNORECASE | re.DOTALL | re.ASCII
 )
+FIELD_COUNT = 4
+TXN_TYPES = ["Debit", "Credit"]
+UTR_SPLIT_RE = re.compile(r'UTR\s*No\.?\s*(?:\:)?\s*', re.IGNORECASE)
+UTR_TOKEN_RE = re.compile(r'(\S+)')
 
 # -----------------------------
 # Sanitization
 # -----------------------------
-def sanitize_text(text):
-    if not isinstance(text, str):
-        return text
-    text = unicodedata.normalize("NFKD", text)
-    text = "".join(ch for ch in text if ord(ch) >= 32)
-    return text.strip()
+# Maps code points 0-31 to None, i.e. deletes control characters
+CONTROL_CHARS = dict.fromkeys(range(32))
+
+def sanitize_column(series):
+    return (
+        series.str.normalize("NFKD")
+        .str.translate(CONTROL_CHARS)
+        .str.strip()
+    )
 
 
 # -----------------------------
 # Safe PDF Extraction
 # -----------------------------
-def safe_extract_text(pdf_path):
+# Unicode whitespace outside ASCII \s (U+3000 is the last), which would
+# otherwise slip past FIELDS_RE: spaces (NBSP, U+202F, ...) become " ",
+# line and record separators "\n".
+UNICODE_SPACES = {
+    c: " " if unicodedata.category(chr(c)) == "Zs" else "\n"
+    for c in range(0x3001)
+    if chr(c).isspace() and chr(c) not in " \t\n\r\f\v"
+}
+
+# pdfminer sometimes emits U+FFFE where the time separator should be;
+# PDFium ends lines with \r\n. Zero-width spaces are dropped.
+TEXT_FIXES = str.maketrans({
+    **UNICODE_SPACES,
+    "\ufffe": ":",
+    "\r": None,
+    "\u200b": None,
+})
+
+def extract_text_pdfium(source):
     """
-    Safely extract text from PDF.
-    Prevents pdfminer crashes from breaking app.
+    Extract raw text with PDFium (C++), skipping pdfminer's layout analysis.
+    Pages are read serially: PDFium is not thread-safe.
     """
     try:
-        text = ""
-        with pdfplumber.open(pdf_path) as pdf:
+        parts = []
+        pdf = pdfium.PdfDocument(source)
+        try:
+            for page in pdf:
+                try:
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range()
+                    textpage.close()
+                    if page_text:
+                        parts.append(page_text.translate(TEXT_FIXES))
+                except Exception:
+                    continue
+                finally:
+                    page.close()
+        finally:
+            pdf.close()
+        return "\n".join(parts)
+    except Exception:
+        return None
+
+
+def extract_text_pdfplumber(source):
+    """
+    Extract layout-aware text with pdfplumber. Slower, kept as fallback.
+    """
+    try:
+        parts = []
+        with pdfplumber.open(source) as pdf:
             for page in pdf.pages:
                 try:
                     page_text = page.extract_text(x_tolerance=2, y_tolerance=2)
                     if page_text:
-                        page_text = page_text.replace("￾", ":")
-                        text += "\n" + page_text
+                        page_text = page_text.translate(TEXT_FIXES)
+                        parts.append(page_text)
                 except Exception:
                     continue
-        return text
+        return "\n".join(parts)
     except Exception:
         return None
 
 
+def is_locked(pdf_bytes):
+    """
+    Cheap lock check: PdfReader only parses the trailer and xref here,
+    so locked files are rejected before any text extraction is attempted.
+    Owner-password-only PDFs open with the empty password and pass.
+    """
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        return reader.is_encrypted and reader.decrypt("") == 0
+    except Exception:
+        return False
+
+
+# Tried in order by load_transactions
+EXTRACTORS = {
+    "pdfium": extract_text_pdfium,
+    "pdfplumber": extract_text_pdfplumber,
+}
+
+
 # -----------------------------
 # Transaction Parser
 # -----------------------------
 def parse_transactions(text):
-    records = []
+    """
+    Returns (df, incomplete): incomplete counts UTR chunks where some
+    field was not found, e.g. because PDFium's stream order scattered a
+    block. The text after the last UTR is the statement's tail and never
+    holds a full row, so it is not counted.
+    """
+    # One list per column; the DataFrame is built from them in one go
+    date_times, details_col, types, amounts, utrs = [], [], [], [], []
+    incomplete = 0
 
     # Split by UTR (strong anchor)
-    chunks = re.split(r'UTR\s*No\.?\s*(?:\:)?\s*', text, flags=re.IGNORECASE)
+    chunks = UTR_SPLIT_RE.split(text)
+    last = len(chunks) - 1
+
+    for i, chunk in enumerate(chunks[1:], 1):
+        utr_match = UTR_TOKEN_RE.match(chunk)
+        utr = utr_match[1] if utr_match else ""
+
+        # Keep the first match of each field, stop once all are found
+        fields = {}
+        for m in FIELDS_RE.finditer(chunk):
+            fields.setdefault(m.lastgroup, m)
+            if len(fields) == FIELD_COUNT:
+                break
+        if len(fields) < FIELD_COUNT and i < last:
+            incomplete += 1
+
+        amt = fields.get("amount")
+        txn_type = amt["type"].title() if amt else ""
+        amount = amt["amount"] if amt else ""
+
+        date = fields.get("date")
+        date = date["date"] if date else ""
+
+        time = fields.get("time")
+        time = time["time"] if time else ""
+
+        details = fields.get("details")
+        details = details["details"].strip() if details else ""
+
+        date_times.append(f"{date} {time}".strip())
+        details_col.append(details)
+        types.append(txn_type)
+        amounts.append(amount)
+        utrs.append(utr)
+
+    df = pd.DataFrame({
+        "Date & Time": date_times,
+        "Transaction Details": details_col,
+        "Type": pd.Categorical(types, categories=TXN_TYPES),
+        "Amount": amounts,
+        "UTR": utrs
+    })
+    if not df.empty:
+        df["Transaction Details"] = sanitize_column(df["Transaction Details"])
+        # Raw "1,200" strings -> numbers in one column-wide pass; missing -> 0
+        df["Amount"] = pd.to_numeric(
+            df["Amount"].str.replace(",", "", regex=False), errors="coerce"
+        ).fillna(0.0).astype("float64")
+    return df, incomplete
 
-    for chunk in chunks[1:]:
-        try:
-            utr_match = re.match(r'(\S+)', chunk)
-            utr = utr_match.group(1) if utr_match else ""
-
-            amt = AMOUNT_RE.search(chunk)
-            txn_type = amt.group(1).title() if amt else ""
-            amount = float(amt.group(2).replace(",", "")) if amt else 0.0
-
-            date = DATE_RE.search(chunk)
-            date = date.group(0) if date else ""
-
-            time = TIME_RE.search(chunk)
-            time = time.group(0) if time else ""
-
-            details = DETAILS_RE.search(chunk)
-            details = details.group(2).strip() if details else ""
-
-            records.append({
-                "Date & Time": f"{date} {time}".strip(),
-                "Transaction Details": details,
-                "Type": txn_type,
-                "Amount": amount,
-                "UTR": utr
-            })
-        except Exception:
-            continue
 
-    df = pd.DataFrame(records)
-    if not df.empty:
-        df["Transaction Details"] = df["Transaction Details"].apply(sanitize_text)
-    return df
+# -----------------------------
+# Cached Pipeline
+# -----------------------------
+# Streamlit hashes the arguments, so re-analyzing the same upload skips
+# PDF extraction and parsing entirely.
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_extract(pdf_bytes, backend):
+    # Both backends read from a buffer, so the upload never touches disk
+    return EXTRACTORS[backend](io.BytesIO(pdf_bytes))
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_parse(text):
+    return parse_transactions(text)
+
+
+def load_transactions(pdf_bytes):
+    """
+    Parse PDFium's text first; re-extract with pdfplumber's layout-aware
+    text only if that yields no text, no transactions or incomplete rows,
+    keeping whichever backend gives more complete rows.
+    Returns (found_text, df).
+    """
+    found_text = False
+    df, incomplete = pd.DataFrame(), 0
+    for backend in EXTRACTORS:
+        text = cached_extract(pdf_bytes, backend)
+        if not text:
+            continue
+        found_text = True
+        parsed, missing = cached_parse(text)
+        if df.empty or len(parsed) - missing > len(df) - incomplete:
+            df, incomplete = parsed, missing
+        if not df.empty and not incomplete:
+            break
+    return found_text, df
 
 
 # -----------------------------
@@ -115,14 +259,55 @@ CATEGORY_RULES = {
     "Shopping": ["collection", "fashion"],
 }
 
+# One alternation per category, matched column-wise. np.select takes the
+# first matching condition, so dict order still decides priority when a
+# row matches several categories.
+CATEGORY_RES = {
+    cat: re.compile("|".join(map(re.escape, words)))
+    for cat, words in CATEGORY_RULES.items()
+}
+
+CATEGORY_LABELS = [*CATEGORY_RULES, "Others"]
+# Measured crossover: below about 1,000 rows the per-category pandas
+# passes cost more than a plain Python loop over the rows
+VECTORIZE_MIN_ROWS = 1000
+
+# Merchants repeat across a statement; repeats are a dict lookup
+@lru_cache(maxsize=4096)
 def categorize(text):
     text = text.lower()
-    for cat, words in CATEGORY_RULES.items():
-        if any(w in text for w in words):
+    for cat, pattern in CATEGORY_RES.items():
+        if pattern.search(text):
             return cat
     return "Others"
 
 
+def categorize_column(details):
+    if len(details) < VECTORIZE_MIN_ROWS:
+        labels = [categorize(text) for text in details]
+    else:
+        lower = details.str.lower()
+        conds = [lower.str.contains(pattern, na=False) for pattern in CATEGORY_RES.values()]
+        labels = np.select(conds, list(CATEGORY_RES), default="Others")
+    return pd.Categorical(labels, categories=CATEGORY_LABELS)
+
+
+# -----------------------------
+# Export
+# -----------------------------
+# Don't auto-link URL-ish strings. constant_memory is deliberately off:
+# pandas writes cells column by column, which that mode truncates.
+EXCEL_OPTIONS = {"strings_to_urls": False}
+
+def to_excel_bytes(df):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(
+        buf, engine="xlsxwriter", engine_kwargs={"options": EXCEL_OPTIONS}
+    ) as writer:
+        df.to_excel(writer, index=False)
+    return buf.getvalue()
+
+
 # -----------------------------
 # Streamlit UI
 # -----------------------------
@@ -141,30 +326,33 @@ download_format = st.radio("Download format", ["csv", "excel"])
 
 if uploaded and st.button("Analyze"):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded.getbuffer())
-            path = tmp.name
+        pdf_bytes = uploaded.getvalue()
 
-        text = safe_extract_text(path)
-        os.remove(path)
+        if is_locked(pdf_bytes):
+            st.error("This PDF is password-protected. Please upload an unlocked copy.")
+            st.stop()
 
-        if not text:
+        found_text, df = load_transactions(pdf_bytes)
+
+        if not found_text:
             st.error("Could not extract text from this PDF.")
             st.stop()
 
-        df = parse_transactions(text)
-
         if df.empty:
             st.error("No transactions found in this PDF.")
             st.stop()
 
-        df["Category"] = df["Transaction Details"].apply(categorize)
+        df["Category"] = categorize_column(df["Transaction Details"])
 
         st.success(f"Parsed {len(df)} transactions")
 
+        # One groupby pass feeds both the metrics and the category chart
+        sums = df.groupby(["Type", "Category"], observed=True, sort=False)["Amount"].sum()
+
         # Metrics
-        total_spent = df[df["Type"] == "Debit"]["Amount"].sum()
-        total_received = df[df["Type"] == "Credit"]["Amount"].sum()
+        totals = sums.groupby(level="Type", observed=True).sum()
+        total_spent = totals.get("Debit", 0.0)
+        total_received = totals.get("Credit", 0.0)
 
         col1, col2 = st.columns(2)
         col1.metric("Total Spent", f"₹{total_spent:,.0f}")
@@ -173,9 +361,7 @@ if uploaded and st.button("Analyze"):
         # Category Chart
         st.subheader("Spending by Category")
         cat_df = (
-            df[df["Type"] == "Debit"]
-            .groupby("Category")["Amount"]
-            .sum()
+            sums.get("Debit", pd.Series(dtype="float64"))
             .sort_values(ascending=False)
         )
         st.bar_chart(cat_df)
@@ -192,15 +378,11 @@ if uploaded and st.button("Analyze"):
                 "phonepe_analysis.csv"
             )
         else:
-            tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-            df.to_excel(tmp_out.name, index=False)
-            with open(tmp_out.name, "rb") as f:
-                st.download_button(
-                    "Download Excel",
-                    f.read(),
-                    "phonepe_analysis.xlsx"
-                )
-            os.remove(tmp_out.name)
+            st.download_button(
+                "Download Excel",
+                to_excel_bytes(df),
+                "phonepe_analysis.xlsx"
+            )
 
     except Exception as e:
         st.error("Unexpected error occurred.")
@@ -1,26 +1,57 @@
 # streamlit_app.py
-# pip install streamlit pdfplumber pandas openpyxl PyPDF2
+# pip install streamlit pdfplumber pypdfium2 pandas xlsxwriter PyPDF2
 
 import streamlit as st
 import pandas as pd
-import tempfile
+import io
 import pdfplumber
-from PyPDF2 import PdfReader, PdfWriter
+import pypdfium2 as pdfium
+from PyPDF2 import PdfReader
 import re
-import os
+import unicodedata
 
 # ---------------- REGEX ----------------
-DATE_RE = re.compile(r'[A-Za-z]{3}\s+\d{1,2},\s*\d{4}')
-TIME_RE = re.compile(r'\d{1,2}:\d{2}\s*(AM|PM)', re.IGNORECASE)
-AMOUNT_RE = re.compile(r'(Debit|Credit)\s+INR\s+([\d,]+\.\d{2})', re.IGNORECASE)
-TID_RE = re.compile(r'Transaction ID\s*:\s*(\S+)')
-UTR_RE = re.compile(r'UTR No\s*:\s*(\S+)')
+# One transaction block: date, details, type and amount on the first
+# line, then time + transaction ID, then UTR. Only the gaps between
+# fields may cross a line break; in-field gaps are [ \t] and possessive.
+# Up to two stray lines (a wrapped merchant name) may sit between the
+# amount and the time, as long as they don't start or end a block.
+TXN_RE = re.compile(
+    r'(?P<date>[A-Za-z]{3}[ \t]++\d{1,2},[ \t]*+\d{4})\s+(?P<details>.{1,200}?)\s+'
+    r'(?P<type>Debit|Credit)[ \t]++INR[ \t]++(?P<amount>[\d,]++\.\d{2})'
+    r'(?:\n(?![ \t]*+[A-Za-z]{3}[ \t]++\d{1,2},|[^\n]*?UTR No)[^\n]*+){0,2}?\s+'
+    r'(?P<time>\d{1,2}:\d{2}[ \t]*+(?:AM|PM))\s+'
+    r'Transaction ID[ \t]*+:[ \t]*+(?P<tid>\S++)\s+'
+    r'UTR No[ \t]*+:[ \t]*+(?P<utr>\S+)',
+    re.IGNORECASE | re.ASCII
+)
+# One per transaction block, parsed or not; tells convert how many
+# blocks TXN_RE missed
+UTR_ANCHOR_RE = re.compile(r'UTR No[ \t]*+:', re.IGNORECASE)
+# Footer / page-number lines that can land between the lines of a block
+NOISE_LINE_RE = re.compile(
+    r'^[^\n]*support\.phonepe\.com[^\n]*$|^[ \t]*page [^\n]*of[^\n]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+# Unicode whitespace outside ASCII \s (U+3000 is the last): spaces
+# (NBSP, U+202F, ...) become " ", line and record separators "\n"
+UNICODE_SPACES = {
+    c: " " if unicodedata.category(chr(c)) == "Zs" else "\n"
+    for c in range(0x3001)
+    if chr(c).isspace() and chr(c) not in " \t\n\r\f\v"
+}
+# Applied to every page in one pass: PDFium's \r\n line ends, Unicode
+# and zero-width spaces that TXN_RE's ASCII whitespace classes would not match
+TEXT_FIXES = str.maketrans({**UNICODE_SPACES, "\r": None, "\u200b": None})
 
 # ---------------- HELPERS ----------------
-def unlock_pdf(path, password):
-    reader = PdfReader(path)
-    if not reader.is_encrypted:
-        return path
+def unlock_pdf(pdf_bytes, password):
+    # Only validates the password; both extractors decrypt natively, so
+    # there is no decrypted copy to write out. Returns the password to use.
+    # Owner-password-only PDFs open with the empty password and need none.
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    if not reader.is_encrypted or reader.decrypt("") != 0:
+        return None
 
     if not password:
         raise ValueError("PDF is encrypted. Password required.")
@@ -28,75 +59,123 @@ def unlock_pdf(path, password):
     if reader.decrypt(password) == 0:
         raise ValueError("Incorrect PDF password.")
 
-    writer = PdfWriter()
-    for p in reader.pages:
-        writer.add_page(p)
+    return password
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    with open(tmp.name, "wb") as f:
-        writer.write(f)
-    return tmp.name
 
-
-def extract_lines(pdf_path):
-    lines = []
-    with pdfplumber.open(pdf_path, laparams={"detect_vertical": False}) as pdf:
+def extract_pages_pdfium(source, password=None):
+    # PDFium's raw text API; no pdfminer layout analysis. Errors return
+    # no pages, so convert falls back to pdfplumber instead of aborting.
+    pages = []
+    try:
+        pdf = pdfium.PdfDocument(source, password=password)
+    except pdfium.PdfiumError:
+        return pages
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            page.close()
+            if text:
+                pages.append(text.translate(TEXT_FIXES))
+    except pdfium.PdfiumError:
+        return []
+    finally:
+        pdf.close()
+    return pages
+
+
+def extract_pages_pdfplumber(source, password=None):
+    pages = []
+    # No laparams: extract_text works from page.chars, and passing them
+    # only makes pdfminer run its layout analysis on every page.
+    with pdfplumber.open(source, password=password) as pdf:
         for page in pdf.pages:
             text = page.extract_text()
-            if not text:
-                continue
-            for raw in text.splitlines():
-                line = raw.strip()
-                if not line:
-                    continue
-                if "support.phonepe.com" in line:
-                    continue
-                if line.lower().startswith("page ") and "of" in line.lower():
-                    continue
-                lines.append(line)
-    return lines
-
-
-def parse_transactions(lines):
-    records = []
-    current = {}
-
-    for line in lines:
-        if DATE_RE.search(line):
-            current["Date"] = DATE_RE.search(line).group()
-
-        if "Paid to" in line or "Received from" in line:
-            current["Details"] = line.replace(current.get("Date", ""), "").strip()
-
-        amt = AMOUNT_RE.search(line)
-        if amt:
-            current["Type"] = amt.group(1).title()
-            current["Amount"] = amt.group(2).replace(",", "")
-
-        time = TIME_RE.search(line)
-        if time:
-            current["Time"] = time.group()
-
-        tid = TID_RE.search(line)
-        if tid:
-            current["Transaction ID"] = tid.group(1)
-
-        utr = UTR_RE.search(line)
-        if utr:
-            current["UTR No"] = utr.group(1)
-
-            # Transaction COMPLETE at UTR
-            records.append({
-                "Date & Time": f"{current.get('Date','')} {current.get('Time','')}".strip(),
-                "Transaction Details": current.get("Details",""),
-                "Transaction ID": current.get("Transaction ID",""),
-                "UTR No": current.get("UTR No",""),
-                "Type": current.get("Type",""),
-                "Amount": current.get("Amount","")
-            })
-            current = {}
-
-    return pd.DataFrame(records)
+            if text:
+                pages.append(text.translate(TEXT_FIXES))
+    return pages
+
+
+# Tried in order by convert
+EXTRACTORS = {
+    "pdfium": extract_pages_pdfium,
+    "pdfplumber": extract_pages_pdfplumber,
+}
+
+
+def extract_text(source, password=None, backend="pdfium"):
+    pages = EXTRACTORS[backend](source, password)
+    return NOISE_LINE_RE.sub("", "\n".join(pages))
+
+
+def parse_transactions(text):
+    date_times, details, tids, utrs, types, amounts = [], [], [], [], [], []
+
+    for m in TXN_RE.finditer(text):
+        date_times.append(f"{m['date']} {m['time']}")
+        details.append(m["details"])
+        tids.append(m["tid"])
+        utrs.append(m["utr"])
+        types.append(m["type"].title())
+        amounts.append(m["amount"])
+
+    df = pd.DataFrame({
+        "Date & Time": date_times,
+        "Transaction Details": details,
+        "Transaction ID": tids,
+        "UTR No": utrs,
+        "Type": types,
+        "Amount": amounts
+    })
+    if not df.empty:
+        df["Amount"] = pd.to_numeric(
+            df["Amount"].str.replace(",", "", regex=False), errors="coerce"
+        ).fillna(0.0)
+    return df
+
+
+# ---------------- CACHE ----------------
+# Keyed on the upload bytes (and password), so reruns of the same file
+# skip extraction, parsing and export.
+@st.cache_data(max_entries=32, show_spinner=False)
+def convert(pdf_bytes, password):
+    # PDFium returns text in content-stream order, which TXN_RE can't
+    # always parse; re-extract with pdfplumber when some UTR anchor has
+    # no row, keeping whichever backend parsed more.
+    # Returns (df, missing): missing counts UTR anchors with no parsed row.
+    password = unlock_pdf(pdf_bytes, password)
+    df, missing = pd.DataFrame(), 0
+    for backend in EXTRACTORS:
+        text = extract_text(io.BytesIO(pdf_bytes), password, backend)
+        parsed = parse_transactions(text)
+        if df.empty or len(parsed) > len(df):
+            df = parsed
+            missing = max(len(UTR_ANCHOR_RE.findall(text)) - len(df), 0)
+        if not df.empty and not missing:
+            break
+    return df, missing
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode("utf-8")
+
+
+# Keep UTR / transaction IDs from being auto-detected as hyperlinks.
+# No constant_memory: to_excel writes column by column, which that mode
+# can't handle (every row but the last would keep only column A).
+EXCEL_OPTIONS = {"strings_to_urls": False}
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def to_excel_bytes(df):
+    buf = io.BytesIO()
+    with pd.ExcelWriter(
+        buf, engine="xlsxwriter", engine_kwargs={"options": EXCEL_OPTIONS}
+    ) as writer:
+        df.to_excel(writer, index=False)
+    return buf.getvalue()
 
 
 # ---------------- UI ----------------
@@ -119,41 +198,33 @@ fmt = st.radio("📄 Output format", ["csv", "excel"])
 
 if uploaded and st.button("🚀 Convert"):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded.getbuffer())
-            source = tmp.name
-
-        source = unlock_pdf(source, password)
-
-        lines = extract_lines(source)
-        df = parse_transactions(lines)
+        df, missing = convert(uploaded.getvalue(), password)
 
         if df.empty:
             st.error("❌ No transactions found. PDF format may be unsupported.")
         else:
             st.success(f"✅ Parsed {len(df)} transactions")
+            if missing:
+                st.warning(
+                    f"⚠️ {missing} transaction(s) could not be parsed "
+                    "and are not in the export."
+                )
             st.dataframe(df.head(10))
 
             if fmt == "csv":
                 st.download_button(
                     "⬇️ Download CSV",
-                    df.to_csv(index=False).encode("utf-8"),
+                    to_csv_bytes(df),
                     "phonepe_transactions.csv",
                     "text/csv"
                 )
             else:
-                out = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-                df.to_excel(out.name, index=False)
-                with open(out.name, "rb") as f:
-                    st.download_button(
-                        "⬇️ Download Excel",
-                        f.read(),
-                        "phonepe_transactions.xlsx",
-                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-                os.remove(out.name)
-
-        os.remove(source)
+                st.download_button(
+                    "⬇️ Download Excel",
+                    to_excel_bytes(df),
+                    "phonepe_transactions.xlsx",
+                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
 
     except Exception as e:
         st.error(str(e))